@@ -3,28 +3,40 @@
 import logging
 import sys
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import re
 import asyncio
+import secrets
+import ssl
+from functools import wraps
+from html import unescape
 from time import time as now
 
-from async_lru import alru_cache
-from aiohttp import ClientSession as HTTPClientSession
+import certifi
+import orjson
+from aiohttp import ClientSession as HTTPClientSession, TCPConnector
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.types import (
     InlineQuery,
-    InputTextMessageContent,
-    InlineQueryResultArticle,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
 )
 from aiogram.utils.exceptions import InvalidQueryID
 from aiogram.types.message import ParseMode
-from aiogram.dispatcher.filters.builtin import CommandStart
+from aiogram.dispatcher.filters import Filter
 from aiogram.dispatcher.handler import SkipHandler
+from aiogram.utils import json as aiogram_json
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows
+    uvloop = None
 
 types.User.__repr__ = lambda u: f"User({u.mention})"
+# aiogram only picks up ujson or rapidjson by itself, falling back to the stdlib json otherwise.
+aiogram_json.dumps = lambda data: orjson.dumps(data).decode()
+aiogram_json.loads = orjson.loads
 
 logger = logging.getLogger("lowvoicebot")
 
@@ -41,44 +53,131 @@ class ReadableException(Exception):
         super().__init__(*args, **kwargs)
 
 
-REGEX_RESOLVE_USER = re.compile(
-    r'<div class="tgme_page_title"><span dir="auto">(.+?)</span></div>'
-)
+class SaveStartFilter(Filter):
+    """Match `/start SAVE_<whisper_id>` deep links by prefix, without going through a regex."""
+
+    PREFIX = "/start SAVE_"
+
+    async def check(self, message: types.Message):
+        text = message.text
+        if text and len(text) > len(self.PREFIX) and text.startswith(self.PREFIX):
+            return {"whisper_id": text[len(self.PREFIX) :]}
+        return False
+
+
+class LowVoiceBot(Bot):
+    # The connector is tuned to keep connections to both the Bot API and t.me alive, as `HTTP_SESSION` shares it.
+    def get_new_session(self):
+        return HTTPClientSession(
+            connector=TCPConnector(
+                limit=200,
+                limit_per_host=30,
+                ttl_dns_cache=600,
+                keepalive_timeout=75,
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+            ),
+            json_serialize=aiogram_json.dumps,
+        )
+
+
+# Usernames are 5 to 32 characters of ASCII letters, digits and underscores, starting with a letter.
+REGEX_USERNAME = re.compile(r"[A-Za-z]\w{4,31}", re.ASCII)
+# The display name is located by plain substring search rather than a regex over the whole page.
+USER_TITLE_OPENER = b'<div class="tgme_page_title"><span dir="auto">'
+USER_TITLE_CLOSER = b"</span></div>"
+# Shared by all lookups so that connections to t.me are pooled and kept alive. It borrows the connector of the
+# bot's own session (see `LowVoiceBot`), which owns and eventually closes it.
+# Created in `on_startup` since a session should be bound to the running event loop.
 HTTP_SESSION = None
 
+RESOLVE_USER_CACHE_SIZE = 4096
+RESOLVE_USER_CACHE_TTL = 60 * 60
+# Maps username to `(name, expire_at)`, in LRU order.
+resolved_users = OrderedDict()
+# Maps username to the pending lookup, so that concurrent misses for one username share a request.
+resolving_users = dict()
+
 
-@alru_cache(maxsize=1024)
 async def resolve_user(username):
-    global HTTP_SESSION
-    if not HTTP_SESSION:
-        HTTP_SESSION = HTTPClientSession()
+    cached = resolved_users.get(username)
+    if cached is not None and cached[1] > now():
+        resolved_users.move_to_end(username)
+        return cached[0]
+    task = resolving_users.get(username)
+    if task is None:
+        task = resolving_users[username] = asyncio.ensure_future(
+            _resolve_user(username)
+        )
+        task.add_done_callback(lambda _: resolving_users.pop(username, None))
+    # Shielded so that one cancelled caller does not abort the lookup for the others.
+    return await asyncio.shield(task)
+
+
+async def _resolve_user(username):
     try:
-        async with HTTP_SESSION.get(f"https://t.me/{username}") as response:
-            assert response.status == 200
-            return REGEX_RESOLVE_USER.search(await response.text()).group(1)
+        name = await fetch_user_name(username)
     except Exception as e:
-        logger.debug(f"Failed to resolve {username} with error {e}")
+        # Not cached, so that a transient failure does not hide a valid username for the whole TTL.
+        logger.debug("Failed to resolve %s with error %s", username, e)
+        return None
+    resolved_users[username] = (name, now() + RESOLVE_USER_CACHE_TTL)
+    resolved_users.move_to_end(username)
+    if len(resolved_users) > RESOLVE_USER_CACHE_SIZE:
+        resolved_users.popitem(last=False)
+    return name
+
+
+# Returns `None` if the page loaded but it has no title, i.e. there is no such user. Raises if the page failed to load.
+async def fetch_user_name(username):
+    async with HTTP_SESSION.get(f"https://t.me/{username}") as response:
+        assert response.status == 200
+        # The body is read in full, even though the title comes early, so that the connection can be
+        # returned to the pool for reuse.
+        page = await response.read()
+    start = page.find(USER_TITLE_OPENER)
+    if start == -1:
         return None
+    start += len(USER_TITLE_OPENER)
+    end = page.find(USER_TITLE_CLOSER, start)
+    if end == -1:
+        return None
+    return unescape(page[start:end].decode())
 
 
-WhisperEntry = namedtuple("WhisperEntry", ("sender", "recipient", "content"))
+# Only what is needed of the sender is kept, rather than holding on to the whole `User` for the lifetime of the whisper.
+WhisperEntry = namedtuple(
+    "WhisperEntry", ("sender_id", "sender_mention", "recipient", "content")
+)
 
-whispers = dict()
+MAX_WHISPERS = 100000
+# Maps whisper id to `(WhisperEntry, TimerHandle)`, the latter expiring the whisper on the event loop.
+# Kept in LRU order so that the least recently used whisper makes way once `MAX_WHISPERS` is reached.
+whispers = OrderedDict()
 
-expiring_tasks = dict()
 
+def add_whisper(id, whisper, expire_in):
+    if len(whispers) >= MAX_WHISPERS:
+        evicted_id, (_, evicted_timer) = whispers.popitem(last=False)
+        evicted_timer.cancel()
+        logger.debug("Message evicted: %s", evicted_id)
+    timer = asyncio.get_running_loop().call_later(expire_in, expire_whisper, id)
+    whispers[id] = (whisper, timer)
 
-def expire_whisper(id, in_seconds=0):
-    if id in expiring_tasks:
-        expiring_tasks[id].cancel()
-        del expiring_tasks[id]
 
-    async def _expire_whisper(id, in_seconds):
-        await asyncio.sleep(in_seconds)
-        expired_whisper = whispers.pop(id)
-        logger.debug(f"Message expired: {expired_whisper!s}")
+def get_whisper(id):
+    entry = whispers.get(id)
+    if entry is None:
+        return None
+    whispers.move_to_end(id)
+    return entry[0]
+
 
-    return _expire_whisper(id, in_seconds)
+def expire_whisper(id):
+    entry = whispers.pop(id, None)
+    if entry is not None:
+        expired_whisper, timer = entry
+        timer.cancel()
+        logger.debug("Message expired: %s", expired_whisper)
 
 
 bot_token = os.environ.get("BOT_TOKEN")
@@ -88,8 +187,78 @@ if not bot_token:
     if not bot_token:
         raise BotTokenUnspecified
 
-bot = Bot(token=bot_token)
+# aiogram binds to the event loop as soon as the bot is constructed, so uvloop is installed before that.
+# The loop is set explicitly as newer uvloop policies no longer create one on `get_event_loop()`.
+if uvloop is not None:
+    uvloop.install()
+asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+bot = LowVoiceBot(token=bot_token)
 dispatcher = Dispatcher(bot)
+# Fetched once in `on_startup` as it is fixed for the lifetime of the bot.
+BOT_USERNAME = None
+SAVE_URL_TEMPLATE = None
+
+MAX_CONCURRENT_HANDLERS = 256
+handler_semaphore = None
+# Maps user id to `(lock, holders)`. The entry is dropped once no handler holds or waits for it.
+user_locks = dict()
+
+
+# aiogram already processes each batch of polled updates in its own task, so a slow handler does not block
+# other users. This bounds the number of handlers in flight and runs those of one user in order.
+def serialized_per_user(handler):
+    @wraps(handler)
+    async def wrapper(query, *args, **kwargs):
+        user_id = query.from_user.id
+        lock, holders = user_locks.get(user_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        user_locks[user_id] = (lock, holders + 1)
+        try:
+            async with lock, handler_semaphore:
+                return await handler(query, *args, **kwargs)
+        finally:
+            lock, holders = user_locks[user_id]
+            if holders == 1:
+                del user_locks[user_id]
+            else:
+                user_locks[user_id] = (lock, holders - 1)
+
+    return wrapper
+
+
+# Maps user id to the task handling their latest inline query.
+inflight_queries = dict()
+
+
+# Inline queries are sent as the user types, and answering a query that has been superseded is wasted work. So a
+# newer query from the same user cancels the one still in flight, up to the point where its answer is sent.
+# The handler runs in a task of its own so that it is that task which gets cancelled, rather than the one aiogram
+# processes the update in, whose cancellation would surface out of the `gather` aiogram awaits updates with.
+def superseded_per_user(handler):
+    @wraps(handler)
+    async def wrapper(query, *args, **kwargs):
+        user_id = query.from_user.id
+        previous = inflight_queries.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        task = inflight_queries[user_id] = asyncio.ensure_future(
+            handler(query, *args, **kwargs)
+        )
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if inflight_queries.get(user_id) is task:
+                del inflight_queries[user_id]
+        if not task.cancelled():
+            return task.result()
+
+    return wrapper
 
 
 # Due to the design limitation of aiogram, the precedence of handler cannot be specified explicitly and only one
@@ -97,7 +266,7 @@ dispatcher = Dispatcher(bot)
 # Therefore, this more generic handler should be loaded after the above so that the above won't be shaded.
 @dispatcher.message_handler(commands=["start"])
 async def start_handler(message: types.Message):
-    logger.debug(f"start_handler:{message.text}")
+    logger.debug("start_handler:%s", message.text)
     args = message.get_args()
     if not args:
         await message.reply(
@@ -114,25 +283,21 @@ async def start_handler(message: types.Message):
         raise SkipHandler
 
 
-@dispatcher.message_handler(CommandStart(re.compile(r"SAVE\_(?P<whisper_id>.+)")))
-async def start_save_handler(message: types.Message, deep_link: re.Match):
-    logger.debug(f"start_save_handler:{deep_link}")
+@dispatcher.message_handler(SaveStartFilter())
+async def start_save_handler(message: types.Message, whisper_id: str):
+    logger.debug("start_save_handler:%s", whisper_id)
     try:
-        try:
-            whisper_id = deep_link.group("whisper_id")
-        except IndexError:
-            raise ReadableException("❌ Malformed arguments")
-        whisper = whispers.get(whisper_id)
+        whisper = get_whisper(whisper_id)
         if whisper is None:
-            logger.debug(f"start_handler:Invalid whisper id: {whisper_id}")
+            logger.debug("start_handler:Invalid whisper id: %s", whisper_id)
             raise ReadableException("⏲️🔔/❌ The message is expired or non-existent.")
         if (
             message.from_user.username != whisper.recipient
-            and message.from_user != whisper.sender
+            and message.from_user.id != whisper.sender_id
         ):
             raise ReadableException("🚫 You are neither the sender nor recipient.")
         await message.answer(
-            f"_Message from_ {whisper.sender.mention} _to_ @{whisper.recipient}:\n\n{whisper.content}",
+            f"_Message from_ {whisper.sender_mention} _to_ @{whisper.recipient}:\n\n{whisper.content}",
             parse_mode=ParseMode.MARKDOWN,
         )
     except ReadableException as e:
@@ -144,11 +309,18 @@ async def ping_handler(message: types.Message):
     await message.reply("Pong")
 
 
+# Maps the content of a `ReadableException` to its inline result, serialized to JSON already, which aiogram passes
+# through as-is. Error results are the same for every user.
+error_results = dict()
+
+
 @dispatcher.inline_handler()
+@superseded_per_user
+@serialized_per_user
 async def whisper_inline_handler(query: InlineQuery):
-    logger.debug(f"whisper_inline_handler")
+    logger.debug("whisper_inline_handler")
     try:
-        bot_username = (await bot.get_me()).username
+        bot_username = BOT_USERNAME
         sender = query.from_user
         if not query.query:
             raise ReadableException(
@@ -171,99 +343,120 @@ async def whisper_inline_handler(query: InlineQuery):
 
         if recipient.startswith("@"):
             recipient = recipient[1:]
-        recipient_name = await resolve_user(recipient)
+        # Checking the form of the username first saves a request to t.me on every keystroke while it is being typed.
+        if not REGEX_USERNAME.fullmatch(recipient):
+            recipient_name = None
+        else:
+            recipient_name = await resolve_user(recipient)
         if recipient_name is None:
             raise ReadableException(
                 ("INVALID_USERNAME", "❌ Invalid Username", "❌ Invalid Username")
             )
-        whisper_id = f"WHISPER-{int(now()):x}-{id(whisper):x}"
-        input_content = InputTextMessageContent(
-            f"*Private Message*\n_To_ {recipient_name}(@{recipient}),\nexpiring in 30 minutes.",
-            parse_mode=ParseMode.MARKDOWN,
-        )
-        button_reveal = InlineKeyboardButton(
-            "🔎 Reveal", callback_data=f"REVEAL|{whisper_id}"
-        )
-        button_save = InlineKeyboardButton(
-            "💾 Save", url=f"https://t.me/{bot_username}?start=SAVE_{whisper_id}"
-        )
-        button_expire = InlineKeyboardButton(
-            "🛑 Expire", callback_data=f"EXPIRE|{whisper_id}"
-        )
-        item_default = InlineQueryResultArticle(
-            id=f"{whisper_id}-1",
+        whisper_id = secrets.token_urlsafe(12)
+        # Results are built as plain dicts in the shape of the Bot API, skipping the construction of aiogram
+        # objects on every keystroke.
+        input_content = {
+            "message_text": f"*Private Message*\n_To_ {recipient_name}(@{recipient}),\nexpiring in 30 minutes.",
+            "parse_mode": ParseMode.MARKDOWN,
+        }
+        button_reveal = {"text": "🔎 Reveal", "callback_data": f"REVEAL|{whisper_id}"}
+        button_save = {"text": "💾 Save", "url": SAVE_URL_TEMPLATE.format(whisper_id)}
+        button_expire = {"text": "🛑 Expire", "callback_data": f"EXPIRE|{whisper_id}"}
+        item_default = {
+            "type": "article",
+            "id": f"{whisper_id}-1",
             # f'✉️ To {recipient_name}, ⏲️ Expire in 30 minutes',
-            title=f"With Save button",
-            input_message_content=input_content,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[button_reveal, button_save, button_expire]]
-            ),
-        )
-        item_nosave = InlineQueryResultArticle(
-            id=f"{whisper_id}-2",
+            "title": "With Save button",
+            "input_message_content": input_content,
+            "reply_markup": {
+                "inline_keyboard": [[button_reveal, button_save, button_expire]]
+            },
+        }
+        item_nosave = {
+            "type": "article",
+            "id": f"{whisper_id}-2",
             # f'✉️ To {recipient_name}, \n⏲️ Expire in 30 minutes, No save button',
-            title=f"Without Save button",
-            input_message_content=input_content,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[button_reveal, button_expire]]
-            ),
-        )
-        try:
-            if (
-                await query.answer(
-                    results=[item_default, item_nosave], cache_time=3, is_personal=True
-                )
-            ) is True:
-                logger.info(
-                    f"From {sender.mention} to {recipient_name}(@{recipient}): WHISPER_REDACTED"
-                )
-                whispers[whisper_id] = WhisperEntry(sender, recipient, whisper)
-                # TODO: permenant trhu  encryption
-                expiring_tasks[whisper_id] = asyncio.create_task(
-                    expire_whisper(whisper_id, 30 * 60)
-                )
-        except InvalidQueryID as e:
-            logger.debug(f"{e} query: {query}, message: {whisper}")
+            "title": "Without Save button",
+            "input_message_content": input_content,
+            "reply_markup": {"inline_keyboard": [[button_reveal, button_expire]]},
+        }
+
+        async def answer_and_store():
+            try:
+                if (
+                    await query.answer(
+                        results=[item_default, item_nosave],
+                        cache_time=3,
+                        is_personal=True,
+                    )
+                ) is True:
+                    logger.info(
+                        f"From {sender.mention} to {recipient_name}(@{recipient}): WHISPER_REDACTED"
+                    )
+                    # TODO: permenant trhu  encryption
+                    add_whisper(
+                        whisper_id,
+                        WhisperEntry(sender.id, sender.mention, recipient, whisper),
+                        30 * 60,
+                    )
+            except InvalidQueryID as e:
+                logger.debug("%s query: %s, message: %s", e, query, whisper)
+
+        # Once the answer is sent, Telegram may show it even if the query gets superseded in the meantime, so the
+        # whisper must still be stored. Hence cancellation is only allowed before this point.
+        await asyncio.shield(answer_and_store())
     except ReadableException as e:
-        logger.debug(f"whisper_inline_handler:ReadableException({e.content})")
-        input_content = InputTextMessageContent(e.content[2], ParseMode.MARKDOWN)
-        item = InlineQueryResultArticle(
-            id=e.content[0], title=e.content[1], input_message_content=input_content
-        )
+        logger.debug("whisper_inline_handler:ReadableException(%s)", e.content)
+        results = error_results.get(e.content)
+        if results is None:
+            results = error_results[e.content] = aiogram_json.dumps(
+                [
+                    {
+                        "type": "article",
+                        "id": e.content[0],
+                        "title": e.content[1],
+                        "input_message_content": {
+                            "message_text": e.content[2],
+                            "parse_mode": ParseMode.MARKDOWN,
+                        },
+                    }
+                ]
+            )
         try:
-            await query.answer(results=[item], cache_time=3600)
+            await query.answer(results=results, cache_time=3600, is_personal=False)
         except InvalidQueryID as e:
-            logger.debug(f"{e}(inside ReadableException) {query}")
+            logger.debug("%s(inside ReadableException) %s", e, query)
 
 
 @dispatcher.callback_query_handler()
+@serialized_per_user
 async def whisper_callback_handler(query: CallbackQuery):
-    logger.debug(f"whisper_reveal_handler")
+    logger.debug("whisper_reveal_handler")
 
     def answer_error(error_text):
         return query.answer(error_text, cache_time=1800)
 
     try:
         action, whisper_id = query.data.split("|", maxsplit=1)
-        whisper = whispers.get(whisper_id)
+        whisper = get_whisper(whisper_id)
         if whisper is None:
             logger.debug(
-                f"whisper_reveal_handler:Invalid whisper id, data: {query.data}"
+                "whisper_reveal_handler:Invalid whisper id, data: %s", query.data
             )
             raise ReadableException("⏲️🔔/❌ The message is expired or non-existent.")
         if (
             query.from_user.username != whisper.recipient
-            and query.from_user != whisper.sender
+            and query.from_user.id != whisper.sender_id
         ):
             raise ReadableException("🚫 You are neither the sender nor recipient.")
         if action == "REVEAL":
             await query.answer(
-                f"From {whisper.sender.mention} to @{whisper.recipient}:\n\n{whisper.content}",
+                f"From {whisper.sender_mention} to @{whisper.recipient}:\n\n{whisper.content}",
                 cache_time=30,
                 show_alert=True,
             )
         elif action == "EXPIRE":
-            await expire_whisper(whisper_id)
+            expire_whisper(whisper_id)
             await query.answer(f"✅ Successfully expired.", cache_time=1800)
         else:
             raise ReadableException("❌ Unsupported Action ❌")
@@ -271,11 +464,27 @@ async def whisper_callback_handler(query: CallbackQuery):
         await answer_error(e.content)
 
 
+async def on_startup(dispatcher):
+    global BOT_USERNAME, SAVE_URL_TEMPLATE, HTTP_SESSION, handler_semaphore
+    BOT_USERNAME = (await bot.get_me()).username
+    SAVE_URL_TEMPLATE = f"https://t.me/{BOT_USERNAME}?start=SAVE_{{}}"
+    HTTP_SESSION = HTTPClientSession(
+        connector=bot.session.connector,
+        connector_owner=False,
+        headers={"User-Agent": "lowvoicebot"},
+    )
+    handler_semaphore = asyncio.Semaphore(MAX_CONCURRENT_HANDLERS)
+
+
+async def on_shutdown(dispatcher):
+    await HTTP_SESSION.close()
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
     # logger.setLevel(logging.DEBUG)
 
-    executor.start_polling(dispatcher)
+    executor.start_polling(dispatcher, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == "__main__":